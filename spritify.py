@@ -21,11 +21,23 @@ Convert rendered frames into a sprite sheet once render is complete.
 # ***** END GPL LICENCE BLOCK *****
 import bpy
 import os
+import re
 import subprocess
 import math
 from bpy.app.handlers import persistent
 import sys
-import shutil
+import tempfile
+import traceback
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    # Only needed by the built-in montage (Blender doesn't bundle Pillow)
+    numpy = Image = None
 
 bl_info = {
     "name": "Spritify",
@@ -35,7 +47,7 @@ bl_info = {
     "location": "Render > Spritify",
     "description": ("Converts rendered frames into a sprite sheet"
                     " once render is complete"),
-    "warning": "Requires ImageMagick",
+    "warning": "Requires ImageMagick (or GraphicsMagick)",
     "wiki_url": ("http://wiki.blender.org/index.php"
                  "?title=Extensions:2.6/Py/Scripts/Render/Spritify"),
     "tracker_url": "https://github.com/FreezingMoon/Spritify/issues",
@@ -46,20 +58,31 @@ bl_info = {
 class SpriteSheetProperties(bpy.types.PropertyGroup):
     filepath: bpy.props.StringProperty(
         name="Sprite Sheet Filepath",
-        description="Save location for sprite sheet (should be PNG format)",
+        description=("Save location for sprite sheet (should be PNG format;"
+                     " leave blank for sprites.png in the render output"
+                     " directory)"),
         subtype='FILE_PATH',
-        default=os.path.join(
-            bpy.context.preferences.filepaths.render_output_directory,
-            "sprites.png"
-        ),
+        default="",
+        # ^ See sheet_filepath: the preferences aren't read at import time.
     )
     imagemagick_path: bpy.props.StringProperty(
-        name="Imagemagick Path",
-        description=("Path where the Imagemagick binaries can be found"
-                     " (only on Linux and macOS)"),
+        name="ImageMagick/GraphicsMagick Path",
+        description=("Path where the ImageMagick binaries (or the"
+                     " GraphicsMagick gm binary) can be found. On Windows,"
+                     " ImageMagick is looked up in the registry first, so"
+                     " this is only needed there for GraphicsMagick or an"
+                     " ImageMagick that isn't registered"),
         subtype='FILE_PATH',
         default='/usr/bin',
     )
+    use_graphicsmagick: bpy.props.BoolProperty(
+        name="Use GraphicsMagick",
+        description=("Call GraphicsMagick (gm montage, gm convert) from the"
+                     " ImageMagick/GraphicsMagick Path instead of"
+                     " ImageMagick; on Windows, set that path to the"
+                     " GraphicsMagick install directory"),
+        default=False,
+    )
     quality: bpy.props.IntProperty(
         name="Quality",
         description="Quality setting for sprite sheet image",
@@ -67,6 +90,14 @@ class SpriteSheetProperties(bpy.types.PropertyGroup):
         max=100,
         default=100,
     )
+    color_mode: bpy.props.EnumProperty(
+        name="Color Mode",
+        description="Pixel format of the sprite sheet image",
+        items=(('RGBA', "RGBA", "8 bits per channel with alpha"),
+               ('INDEXED', "Indexed",
+                "256 color palette (smaller and faster to load)")),
+        default='RGBA',
+    )
     is_rows: bpy.props.EnumProperty(
         name="Rows/Columns",
         description="Choose if tiles will be arranged by rows or columns",
@@ -114,6 +145,13 @@ class SpriteSheetProperties(bpy.types.PropertyGroup):
                      " when rendering is complete"),
         default=True,
     )
+    use_builtin_montage: bpy.props.BoolProperty(
+        name="Built-in Montage",
+        description=("Compose sprite sheets inside Blender with NumPy and"
+                     " Pillow instead of calling montage (also used when"
+                     " montage can't be found)"),
+        default=False,
+    )
     support_multiview: bpy.props.BoolProperty(
         name="Support Multiviews",
         description=("Render multiple spritesheets based on multiview"
@@ -122,6 +160,7 @@ class SpriteSheetProperties(bpy.types.PropertyGroup):
     )
 
 
+@functools.lru_cache(maxsize=1)
 def find_bin_path_windows():
     import winreg
 
@@ -136,10 +175,299 @@ def find_bin_path_windows():
     except WindowsError:
         return None
 
-    print(value)
     return value
 
 
+def sheet_filepath(spritesheet):
+    '''
+    Get the sprite sheet path, defaulting to sprites.png in the render
+    output directory preference. That default is looked up on use rather
+    than as the property default, since the preferences may not be
+    available yet when the add-on is imported.
+    '''
+    if spritesheet.filepath:
+        return spritesheet.filepath
+    return os.path.join(
+        bpy.context.preferences.filepaths.render_output_directory,
+        "sprites.png"
+    )
+
+
+def magick_command(bin_path, tool, use_graphicsmagick=False):
+    '''
+    Get the command prefix for an ImageMagick tool such as "montage" or
+    "convert" (or for its "gm <tool>" GraphicsMagick equivalent, which
+    accepts the same arguments).
+    '''
+    if use_graphicsmagick:
+        return [os.path.join(bin_path, "gm"), tool]
+    return [os.path.join(bin_path, tool)]
+
+
+def dir_nonempty(path):
+    '''
+    Check if a directory has any entry, stopping at the first one instead
+    of listing the whole directory.
+    '''
+    with os.scandir(path) as entries:
+        return next(entries, None) is not None
+
+
+def decode_frame(path, background, make_gif=False):
+    '''
+    Decode a frame to an RGBA array, closing the file once it's decoded.
+    Returns it with a GIF palette copy of the frame as rendered, before
+    the background is drawn in (like convert gets it), if make_gif is set,
+    or else with None.
+    '''
+    with Image.open(path) as image:
+        frame = image.convert("RGBA")
+    gif = gif_frame(numpy.asarray(frame)) if make_gif else None
+    if background[3]:
+        # Frames are drawn over the background, like montage does
+        frame = Image.alpha_composite(
+            Image.new("RGBA", frame.size, background), frame
+        )
+    return numpy.asarray(frame), gif
+
+
+def iter_frames(images, background, decoder=None, make_gif=False):
+    '''
+    Yield the decoded frames in order (see decode_frame). With a decoder
+    executor, frames are decoded ahead on its threads (Pillow releases the
+    GIL while inflating PNGs), but never more than two per CPU, so memory
+    stays bounded whatever the number of frames. Without one, only a
+    single frame is ever resident next to the sheet.
+    '''
+    if decoder is None:
+        for path in images:
+            yield decode_frame(path, background, make_gif)
+        return
+    window = 2 * (os.cpu_count() or 1)
+    pending = collections.deque()
+    for path in images:
+        pending.append(decoder.submit(decode_frame, path, background,
+                                      make_gif))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def gif_frame(frame):
+    '''
+    Quantize an RGBA frame to a GIF palette image, keeping index 255 for
+    the (mostly) transparent pixels.
+    '''
+    image = Image.fromarray(frame[..., :3], "RGB").quantize(colors=255)
+    indices = numpy.array(image)
+    indices[frame[..., 3] < 128] = 255
+    palette = image.getpalette()[:255 * 3]
+    palette += [0] * (256 * 3 - len(palette))
+    image = Image.fromarray(indices, "P")
+    image.putpalette(palette)
+    image.info["transparency"] = 255
+    return image
+
+
+def builtin_montage(images, destination, is_rows, tiles, width, height,
+                    offset_x, offset_y, bg_color, quality, indexed=False,
+                    gif_frames=None, decoder=None):
+    '''
+    Compose a sprite sheet in-process, laid out like montage's -tile and
+    -geometry: each frame is centered in a width x height tile with an
+    offset_x/offset_y border, over the bg_color background. Indexed
+    sheets are quantized to a 256 color palette before being saved.
+    Frames are streamed into the preallocated sheet, decoded ahead on the
+    decoder executor if one is given (see iter_frames). If a
+    gif_frames list is given, a palette copy of each frame as rendered is
+    appended to it too, so the animated GIF doesn't decode them again.
+    '''
+    if is_rows == 'ROWS':
+        columns = min(tiles, len(images))
+    else:
+        columns = math.ceil(len(images) / tiles)
+    rows = math.ceil(len(images) / columns)
+    tile_width = width + 2 * offset_x
+    tile_height = height + 2 * offset_y
+    background = tuple(round(channel * 255) for channel in bg_color)
+
+    sheet = numpy.empty((rows * tile_height, columns * tile_width, 4),
+                        dtype=numpy.uint8)
+    sheet[:] = background
+    frames = iter_frames(images, background, decoder, gif_frames is not None)
+    for index, (frame, gif) in enumerate(frames):
+        if gif is not None:
+            gif_frames.append(gif)
+        frame = frame[:height, :width]
+        frame_height, frame_width = frame.shape[:2]
+        row, column = divmod(index, columns)
+        y = row * tile_height + offset_y + (height - frame_height) // 2
+        x = column * tile_width + offset_x + (width - frame_width) // 2
+        sheet[y:y + frame_height, x:x + frame_width] = frame
+    image = Image.fromarray(sheet, "RGBA")
+    if indexed:
+        image = image.quantize(256, method=Image.FASTOCTREE)
+    # PNG quality works like montage's: the tens are the zlib level
+    image.save(destination, compress_level=min(quality // 10, 9))
+
+
+# The latest directory listing by path, as (mtime, [(name, path), ...]) of
+#   the files
+listing_cache = {}
+
+
+def list_files(directory):
+    '''
+    List the names and paths of the files in a directory. The listing is
+    reused while the directory's mtime stays the same, so regenerating a
+    sheet with new settings doesn't rescan thousands of frames.
+    '''
+    mtime = os.stat(directory).st_mtime_ns
+    key = os.path.normpath(directory)
+    cached = listing_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(directory) as entries:
+        files = [(entry.name, entry.path) for entry in entries
+                 if entry.is_file()]
+    listing_cache.clear()
+    # ^ Only one render directory is kept
+    listing_cache[key] = (mtime, files)
+    return files
+
+
+def refresh_listing(directory):
+    '''
+    Keep the cached listing of directory valid once the add-on has written
+    its sheets or GIF there. Those are never taken for frames (see
+    sheet_matcher), so only the mtime that writing them changed needs
+    updating; otherwise every run would rescan the frames.
+    '''
+    key = os.path.normpath(directory)
+    cached = listing_cache.get(key)
+    if cached is not None:
+        listing_cache[key] = (os.stat(directory).st_mtime_ns, cached[1])
+
+
+# Longest command line, as Windows quotes it, to pass the frames on; with
+#   more frames they go in an "@" list file (Windows allows 32767
+#   characters for the whole command line)
+ARGV_LIMIT = 32000
+
+
+def write_list_file(images):
+    '''
+    Write image paths to a temporary ImageMagick response file, passed as
+    "@<file>", so that long animations can't overflow the command line.
+    Each path is quoted with a quote character that it doesn't contain.
+    The caller removes the file once the command is done.
+    '''
+    with tempfile.NamedTemporaryFile(
+            mode='w', suffix=".txt", encoding='utf-8',
+            delete=False) as listfile:
+        for image in images:
+            quote = "'" if '"' in image else '"'
+            listfile.write('{0}{1}{0}\n'.format(quote, image))
+    return listfile.name
+
+
+def run_magick(command, images, destination, env=None):
+    '''
+    Run an ImageMagick (or GraphicsMagick) command, with its options, on
+    images, writing destination. The images go on the command line, or in
+    a list file if they would make it too long (see write_list_file).
+    Some distributions' security policy forbids reading "@" files, in
+    which case the command line is used anyway.
+    Returns the finished process, with its stderr kept for reporting.
+    '''
+    def run(sources):
+        return subprocess.run(
+            command + sources + [destination],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            errors='replace',
+        )
+
+    command_line = subprocess.list2cmdline(command + images + [destination])
+    if (len(command_line) <= ARGV_LIMIT
+            or any('"' in image and "'" in image for image in images)):
+        return run(images)
+    listfile = write_list_file(images)
+    try:
+        result = run(["@" + listfile])
+    finally:
+        os.remove(listfile)
+    if result.returncode and "not authorized" in result.stderr:
+        result = run(images)
+    return result
+
+
+def temp_path(path):
+    '''
+    Get the temporary path that an output is written to before it replaces
+    path (keeping the extension, which tells ImageMagick the format).
+    '''
+    root, ext = os.path.splitext(path)
+    return root + ".tmp" + ext
+
+
+def remove_temp(path):
+    '''
+    Remove path's temporary output if there is one, so that one left over
+    by an earlier run can't be taken for a new one (see replace_with_temp).
+    '''
+    try:
+        os.remove(temp_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def replace_with_temp(path):
+    '''
+    Atomically replace path with its temporary output, if that was written.
+    Returns whether it was. Outputs call remove_temp before they are made,
+    so a stale file never passes for a new one.
+    '''
+    if not os.path.isfile(temp_path(path)):
+        return False
+    os.replace(temp_path(path), path)
+    return True
+
+
+def view_suffixes(spritesheet, render):
+    '''
+    Get the file suffix of each view that gets its own sprite sheet (just
+    "" unless the views are rendered to separate files).
+    '''
+    if (spritesheet.support_multiview and render.use_multiview
+            and render.views_format == 'MULTIVIEW'):
+        return [view.file_suffix for view in render.views]
+    return ['']
+
+
+def sheet_matcher(directory, sheet_path, suffixes):
+    '''
+    Get a function that matches the names of the sprite sheets spritify
+    writes into directory: whole or split into "-<index>-" files, for each
+    view suffix, and their temporary outputs. Sheets left there by a
+    previous run (even one split into more files) then aren't taken for
+    frames, while frames that merely start with the sheet's name are kept.
+    '''
+    sheet_dir, sheet_name = os.path.split(sheet_path)
+    if (os.path.normcase(os.path.normpath(sheet_dir))
+            != os.path.normcase(os.path.normpath(directory))):
+        return lambda name: None
+    stem, ext = os.path.splitext(sheet_name)
+    return re.compile(r"{}(-\d+-)?({})(\.tmp)?{}\Z".format(
+        re.escape(stem),
+        "|".join(re.escape(suffix) for suffix in suffixes),
+        re.escape(ext),
+    ), re.IGNORECASE if os.name == "nt" else 0).match
+
+
 def show_message(operator, message, title="Spritify", icon='INFO'):
     def draw(self, context):
         self.layout.label(text=message)
@@ -161,41 +489,133 @@ def show_message(operator, message, title="Spritify", icon='INFO'):
     '''
 
 @persistent
-def spritify(scene, operator):
-    if scene.spritesheet.auto_sprite:
+def spritify(scene, operator, make_gif=False):
+    spritesheet = scene.spritesheet
+    render = scene.render
+    # ^ Each RNA attribute access has a cost, so look these up once
+    if spritesheet.auto_sprite:
         print("[Spritify] Making sprite sheet")
-        # Remove existing spritesheet if it's already there
-        if os.path.exists(bpy.path.abspath(scene.spritesheet.filepath)):
-            os.remove(bpy.path.abspath(scene.spritesheet.filepath))
+        sheet_path = bpy.path.abspath(sheet_filepath(spritesheet))
+        sheet_stem, sheet_ext = os.path.splitext(sheet_path)
+        # ^ An existing spritesheet is only replaced once a new one has been
+        #   written (see replace_with_temp).
 
-        if scene.spritesheet.is_rows == 'ROWS':
-            tile_setting = str(scene.spritesheet.tiles) + "x"
+        if spritesheet.is_rows == 'ROWS':
+            tile_setting = str(spritesheet.tiles) + "x"
         else:
-            tile_setting = "x" + str(scene.spritesheet.tiles)
-
-        suffixes = []
+            tile_setting = "x" + str(spritesheet.tiles)
+
+        suffixes = view_suffixes(spritesheet, render)
+        # Preload images (frames are only rendered to the top directory,
+        #   so a single listing fills the bucket of every view suffix)
+        render_dir = bpy.path.abspath(render.filepath)
+        buckets = {suffix: [] for suffix in suffixes}
+        needles = {}
+        # ^ Buckets by "<suffix>.png" needle, grouped by the needle length,
+        #   so matching a frame is a dict lookup per length, not per view.
+        for suffix in suffixes:
+            needle = suffix + ".png"
+            needles.setdefault(len(needle), {})[needle] = buckets[suffix]
+        if os.path.isdir(render_dir):
+            is_sheet = sheet_matcher(render_dir, sheet_path, suffixes)
+            for name, path in list_files(render_dir):
+                if is_sheet(name):
+                    continue  # A previous sprite sheet, not a frame
+                for length, needle_buckets in needles.items():
+                    bucket = needle_buckets.get(name[-length:])
+                    if bucket is not None:
+                        bucket.append(path)
+        bin_path = spritesheet.imagemagick_path
+        if os.name == "nt" and not spritesheet.use_graphicsmagick:
+            bin_path = find_bin_path_windows() or bin_path
+
+        # Whole pixels, rounded the way Blender sizes the render
+        width = render.resolution_x * render.resolution_percentage // 100
+        height = render.resolution_y * render.resolution_percentage // 100
+
+        if render.use_crop_to_border:
+            width = (int(render.border_max_x * width)
+                     - int(render.border_min_x * width))
+            height = (int(render.border_max_y * height)
+                      - int(render.border_min_y * height))
+        # montage reads rgba() channels as 0-255 and the alpha as 0.0-1.0
+        #   (the channels used to be scaled to 0-100 without a "%")
+        bg_color = tuple(spritesheet.bg_color)
+        background = "rgba({},{},{},{:.3f})".format(
+            round(bg_color[0] * 255),
+            round(bg_color[1] * 255),
+            round(bg_color[2] * 255),
+            bg_color[3],
+        )
+        geometry = "{}x{}+{}+{}".format(
+            width,
+            height,
+            spritesheet.offset_x,
+            spritesheet.offset_y
+        )
+        use_builtin = spritesheet.use_builtin_montage
+        if not use_builtin:
+            montage_command = magick_command(
+                bin_path, "montage", spritesheet.use_graphicsmagick
+            )
+            montage_path = montage_command[0]
+            if not os.path.isfile(montage_path):
+                if Image is None:
+                    raise FileNotFoundError(
+                        'The executable "{}" does not exist.'
+                        '\nTIP: Make sure ImageMagick (or GraphicsMagick)'
+                        ' is installed and that'
+                        ' the bin directory is correct'
+                        ' in Render Properties, Spritify.'
+                        ''.format(montage_path)
+                    )
+                use_builtin = True
+        if use_builtin and Image is None:
+            raise ImportError(
+                'The built-in montage requires NumPy and Pillow.'
+                '\nTIP: Install Pillow into Blender\'s Python'
+                ' or disable Built-in Montage.'
+            )
+        indexed = spritesheet.color_mode == 'INDEXED'
+        montage_call = None
+        output_format = ""
+        if not use_builtin:
+            depth = "8"
+            montage_call = montage_command + [
+                "-depth",
+                depth,
+                "-tile",
+                tile_setting,
+                "-geometry",
+                geometry,
+                "-background",
+                background,
+                "-quality",
+                str(spritesheet.quality),
+            ]  # See run_magick for source & destination
+            if indexed:
+                montage_call += ["-colors", "256"]
+                output_format = "PNG8:"
 
-        if (scene.spritesheet.support_multiview and scene.render.use_multiview
-                and scene.render.views_format == 'MULTIVIEW'):
-            for view in scene.render.views:
-                suffixes.append(view.file_suffix)
-        else:
-            suffixes.append('')
         destination = None
+        destinations = []
+        montage_jobs = []
+        decoder = ThreadPoolExecutor(max_workers=os.cpu_count())
+        # ^ Shared by all built-in montage jobs to decode frames, so they
+        #   don't start a pool each. Threads only start once it's used.
+        gif_frames = []
+        # ^ The built-in montage makes the GIF frames while it has them
+        #   decoded (see render_complete), one list per job to keep them
+        #   in order. Only for a single view, as gifify would mix views.
+        env = os.environ.copy()
+        split = spritesheet.files > 1
         for suffix in suffixes:
             print('[Spritify] Preloading suffix "{}"'.format(suffix))
-            # Preload images
-            images = []
-            render_dir = bpy.path.abspath(scene.render.filepath)
-            for dirname, dirnames, filenames in os.walk(render_dir):
-                for filename in sorted(filenames):
-                    if filename.endswith("%s.png" % suffix):
-                        images.append(os.path.join(dirname, filename))
+            images = buckets[suffix]
+            images.sort()
 
             # Calc number of images per file
-            per_file = math.ceil(len(images) / scene.spritesheet.files)
-            offset = 0
-            index = 0
+            per_file = math.ceil(len(images) / spritesheet.files)
 
             if len(images) < 1:
                 raise FileNotFoundError(
@@ -206,92 +626,109 @@ def spritify(scene, operator):
                     ''.format(render_dir)
                 )
             print("[Spritify] Processing {} image(s)".format(len(images)))
-            # While is faster than for+range
             if per_file < 1:
                 raise ValueError("The offset cannot be less than 1.")
-                # ^ Prevent an infinite loop.
-
-            while offset < len(images):
-                current_images = images[offset:offset+per_file]
-                filename = scene.spritesheet.filepath
-                if scene.spritesheet.files > 1:
-                    filename = "%s-%d-%s%s" % (scene.spritesheet.filepath[:-4],
-                                               index, suffix,
-                                               scene.spritesheet.filepath[-4:])
+                # ^ Prevent dividing the frames into zero-sized files.
+
+            # Only the index changes between this suffix's files
+            head = sheet_stem + "-"
+            tail = "-" + suffix + sheet_ext
+            whole = sheet_stem + suffix + sheet_ext
+
+            for index in range(math.ceil(len(images) / per_file)):
+                start = index * per_file
+                if split:
+                    filename = head + str(index) + tail
                 else:
-                    filename = "%s%s%s" % (scene.spritesheet.filepath[:-4],
-                                           suffix,
-                                           scene.spritesheet.filepath[-4:])
+                    filename = whole
                 print('[Spritify] processing "{}"'.format(filename))
-                bin_path = scene.spritesheet.imagemagick_path
-
-                if os.name == "nt":
-                    bin_path = find_bin_path_windows()
-
-                width = (scene.render.resolution_x
-                         * scene.render.resolution_percentage / 100)
-                height = (scene.render.resolution_y
-                          * scene.render.resolution_percentage / 100)
-
-                if scene.render.use_crop_to_border:
-                    width = (scene.render.border_max_x
-                             * width - scene.render.border_min_x * width)
-                    height = (scene.render.border_max_y
-                              * height - scene.render.border_min_y * height)
-                background = (
-                    "rgba({},{},{},{})".format(
-                        str(scene.spritesheet.bg_color[0] * 100),
-                        str(scene.spritesheet.bg_color[1] * 100),
-                        str(scene.spritesheet.bg_color[2] * 100),
-                        str(scene.spritesheet.bg_color[3] * 100),
-                    )
-                )
-                geometry = "{}x{}+{}+{}".format(
-                    width,
-                    height,
-                    scene.spritesheet.offset_x,
-                    scene.spritesheet.offset_y
+                destination = filename
+                destinations.append(destination)
+                remove_temp(destination)
+                if use_builtin:
+                    job_gif_frames = None
+                    if make_gif and len(suffixes) == 1:
+                        job_gif_frames = []
+                        gif_frames.append(job_gif_frames)
+                    montage_jobs.append(functools.partial(
+                        builtin_montage,
+                        images[start:start + per_file],
+                        temp_path(destination),
+                        spritesheet.is_rows,
+                        spritesheet.tiles,
+                        width,
+                        height,
+                        spritesheet.offset_x,
+                        spritesheet.offset_y,
+                        bg_color,
+                        spritesheet.quality,
+                        indexed,
+                        job_gif_frames,
+                        decoder,
+                    ))
+                else:
+                    montage_jobs.append(functools.partial(
+                        run_magick,
+                        montage_call,
+                        images[start:start + per_file],
+                        output_format + temp_path(destination),
+                        env,
+                    ))
+
+        # Every sheet (per file and per view) is an independent montage
+        #   process, so run them side by side. Share the cores out between
+        #   them so that together they fill the machine without
+        #   oversubscribing it (OMP_NUM_THREADS is what GraphicsMagick reads).
+        if len(montage_jobs) > 1:
+            threads = str(max(1, (os.cpu_count() or 1) // len(montage_jobs)))
+            env["MAGICK_THREAD_LIMIT"] = threads
+            env["OMP_NUM_THREADS"] = threads
+
+        try:
+            with decoder, ThreadPoolExecutor(
+                    max_workers=os.cpu_count()) as executor:
+                results = list(executor.map(lambda job: job(), montage_jobs))
+        except BaseException:
+            # Don't leave the other jobs' outputs behind
+            for path in destinations:
+                remove_temp(path)
+            raise
+        # print("[Spritify]", montage_jobs, "results:", results)
+        # ^ still 1 even if succeeds for some reason
+        written = [replace_with_temp(path) for path in destinations]
+        gif_destination = None
+        gif_frames = [frame for frames in gif_frames for frame in frames]
+        if gif_frames:
+            gif_destination = sheet_stem + ".gif"
+            remove_temp(gif_destination)
+            try:
+                gif_frames[0].save(
+                    temp_path(gif_destination),
+                    save_all=True,
+                    append_images=gif_frames[1:],
+                    duration=round(1000 / render.fps),
+                    loop=0,
+                    disposal=2,
+                    transparency=255,
+                    optimize=False,
                 )
-                montage_path = os.path.join(bin_path, "montage")
-                if not os.path.isfile(montage_path):
-                    raise FileNotFoundError(
-                        'The executable "{}" does not exist.'
-                        '\nTIP: Make sure ImageMagick is installed and that'
-                        ' the bin directory is correct'
-                        ' in Render Properties, Spritify.'
-                        ''.format(montage_path)
-                    )
-                depth = "8"
-                destination = bpy.path.abspath(filename)
-                montage_call = [
-                    montage_path,
-                    "-depth",
-                    depth,
-                    "-tile",
-                    tile_setting,
-                    "-geometry",
-                    geometry,
-                    "-background",
-                    background,
-                    "-quality",
-                    str(scene.spritesheet.quality),
-                ]  # See extend below for source, & append for destination
-                montage_call.extend(current_images)
-                montage_call.append(destination)
-
-                result = subprocess.call(montage_call)
-                # print("[Spritify]", montage_call, "result:", result)
-                # ^ still 1 even if succeeds for some reason
-                offset += per_file
-                index += 1
-        if os.path.isfile(destination):
+            except BaseException:
+                remove_temp(gif_destination)
+                raise
+            replace_with_temp(gif_destination)
+        refresh_listing(os.path.dirname(sheet_path))
+        if all(written):
             msg = ('Spritify finished writing auto_sprite "{}".'
                    ''.format(destination))
             show_message(operator, msg, title="spritify")
-            return {'message': msg}
+            return {'message': msg, 'gif': gif_destination}
         else:
+            failed = written.index(False)
             msg = ('Spritify failed to write auto_sprite "{}".'
-                   ''.format(destination))
+                   ''.format(destinations[failed]))
+            stderr = getattr(results[failed], 'stderr', None)
+            if stderr:
+                msg += "\n" + stderr.strip()
             show_message(operator, msg, icon="ERROR", title="spritify")
             return {'error': msg}
 
@@ -299,118 +736,125 @@ def spritify(scene, operator):
 
 @persistent
 def gifify(scene, operator):
-    if scene.spritesheet.auto_gif:
+    spritesheet = scene.spritesheet
+    render = scene.render
+    if spritesheet.auto_gif:
         print("[Spritify] Generating animated GIF")
-        # Remove existing animated GIF if it's already there
-        #   (uses the same path as the spritesheet)
-        if os.path.exists(
-                bpy.path.abspath(scene.spritesheet.filepath[:-3] + "gif")
-                ):
-            os.remove(bpy.path.abspath(scene.spritesheet.filepath[:-3] + "gif"))
+        # The animated GIF uses the same path as the spritesheet
+        sheet_path = bpy.path.abspath(sheet_filepath(spritesheet))
+        destination = os.path.splitext(sheet_path)[0] + ".gif"
+        bin_path = spritesheet.imagemagick_path
 
         # If windows, try and find binary
-        converter_path = "%s/convert" % scene.spritesheet.imagemagick_path
-        # ^ formerly convert_path which was ambiguous (See new try_path
-        #   for temp image files).
-
-        if os.name == "nt":
-            bin_path = find_bin_path_windows()
+        if os.name == "nt" and not spritesheet.use_graphicsmagick:
+            bin_path = find_bin_path_windows() or bin_path
 
-            if bin_path:
-                converter_path = os.path.join(bin_path, "convert")
+        converter_command = magick_command(
+            bin_path, "convert", spritesheet.use_graphicsmagick
+        )
+        converter_path = converter_command[0]
+        # ^ formerly convert_path which was ambiguous.
 
         if not os.path.isfile(converter_path):
             raise FileNotFoundError(
                 'The executable "{}" does not exist.'
-                '\n\nTIP: Make sure ImageMagick is installed and that'
-                ' the bin directory is correct in Render Properties, Spritify.'
+                '\n\nTIP: Make sure ImageMagick (or GraphicsMagick) is'
+                ' installed and that the bin directory is correct'
+                ' in Render Properties, Spritify.'
                 ''.format(converter_path)
             )
 
-        mixed_files_path, name_partial = os.path.split(scene.render.filepath)
+        source = bpy.path.abspath(render.filepath)
+        mixed_files_path, name_partial = os.path.split(source)
         # ^ It is a partial name--It may have numbers after it.
-        # partial, dotext = os.path.splitext(name_partial)
-        found_any_file = None
-        source = bpy.path.abspath(scene.render.filepath) + "*"
-        # ^ The scene render filepath becomes part of each png
-        #   frame filename.
-        convert_tmp_dir = os.path.join(mixed_files_path, "spritify")
-        if os.path.isdir(convert_tmp_dir):
-            shutil.rmtree(convert_tmp_dir)
-        os.makedirs(convert_tmp_dir)
+        # The scene render filepath becomes part of each png frame
+        #   filename. List those frames here: subprocess doesn't go through
+        #   a shell, so a "*" pattern would reach convert unexpanded.
+        frames = []
         if os.path.isdir(mixed_files_path):
-            for sub in os.listdir(mixed_files_path):
-                if sub.startswith("."):
-                    continue
-                if sub.lower().endswith(".tmp"):
-                    continue
-                if sub.lower().endswith(".txt"):
-                    # such as {blendfilename.splitext()[0]}.crash.txt
-                    continue
-                if not sub.lower().endswith(".png"):
-                    # Allow *only* png animation frames!
-                    continue
-                sub_path = os.path.join(mixed_files_path, sub)
-                if not os.path.isfile(sub_path):
-                    continue
-                found_any_file = sub_path
-                new_path = os.path.join(convert_tmp_dir, sub)
-                shutil.move(sub_path, new_path)
-                break
-
-        if found_any_file is None:
-            caveat = ""
+            is_sheet = sheet_matcher(mixed_files_path, sheet_path,
+                                     view_suffixes(spritesheet, render))
+            # ^ The same sprite sheets spritify leaves out of its frames
+            frames = sorted(
+                path for name, path in list_files(mixed_files_path)
+                if name.startswith(name_partial)
+                and not name.startswith(".")
+                # Allow *only* png animation frames!
+                and name.lower().endswith(".png")
+                and not is_sheet(name)
+            )
+
+        if not frames:
             raise FileNotFoundError(
-                'There are no "{}" PNG files.'
+                'There are no "{}*" PNG files.'
                 '\n\nGenerating GIF requires:'
                 '\n1. Output Properties: Set format to PNG'
                 '\n2. Render, Render Animation.'
                 '\n3. Generate Sprite Sheet'
                 ''.format(source)
             )
-        delay = "1x" + str(scene.render.fps)
+        delay = "1x" + str(render.fps)
         dispose = "background"
         loop = "0"
-        destination = bpy.path.abspath(scene.spritesheet.filepath[:-3] + "gif")
-        if os.path.isfile(destination):
-            show_message(operator, 'Overwriting "{}"'.format(destination))
-            os.remove(destination)
-        if not os.path.isdir(convert_tmp_dir):
-            raise FileNotFoundError(
-                'convert_tmp_dir does not exist: "{}"'
-                ''.format(convert_tmp_dir)
+        remove_temp(destination)
+        try:
+            result = run_magick(
+                converter_command + [
+                    "-delay",
+                    delay,
+                    "-dispose",
+                    dispose,
+                    "-loop",
+                    loop,
+                ],
+                frames,
+                # FIXME: ^ scene.render.filepath assumes the png files in the
+                #   render path are only for the rendered animation
+                temp_path(destination),
             )
-        subprocess.call([
-            convert_tmp_dir,
-            "-delay",
-            delay,
-            "-dispose",
-            dispose,
-            "-loop",
-            loop,
-            source,
-            # FIXME: ^ scene.render.filepath assumes the files in the
-            #   render path are only for the rendered animation
-            destination
-        ])
-        if os.path.isfile(destination):
+        except BaseException:
+            remove_temp(destination)
+            raise
+        written = replace_with_temp(destination)
+        refresh_listing(os.path.dirname(destination))
+        if written:
             msg = 'Spritify finished writing auto_gif "{}".'.format(destination)
             show_message(operator, msg, title="Spritify gifify")
             return {'message': msg}
         else:
-            msg = 'Spritify failed to create auto_gif "{}".'.format(destination)
+            msg = ('Spritify failed to create auto_gif "{}"'
+                   ' ({} exited with status {}).'
+                   ''.format(destination, converter_path, result.returncode))
+            if result.stderr:
+                msg += "\n" + result.stderr.strip()
             show_message(operator, msg, icon="ERROR", title="Spritify gifify")
             return {'error': msg}
 
 
-class SpritifyOperator(bpy.types.Operator):
-    """
-    Generate a sprite sheet from completed animation render
-    (This operator just wraps the handler to make things easy if
-    auto_sprite is False).
-    """
-    bl_idname = "render.spritify"
-    bl_label = "Generate a sprite sheet from a completed animation render"
+@persistent
+def render_complete(scene, operator):
+    '''
+    Make the sprite sheet and then the animated GIF once a render is
+    complete. When the built-in montage is used, spritify encodes the GIF
+    from the frames it already decoded, so gifify doesn't run.
+    '''
+    results = None
+    try:
+        results = spritify(scene, operator,
+                           make_gif=scene.spritesheet.auto_gif)
+    except Exception:
+        traceback.print_exc()
+        # ^ Report it like Blender reports a failed handler, but still make
+        #   the GIF, as when each had a handler of its own.
+    if results is None or results.get('gif') is None:
+        gifify(scene, operator)
+
+
+class SpritifyOperatorMixin:
+    '''
+    The poll and result reporting shared by SpritifyOperator and
+    GIFifyOperator.
+    '''
 
     @classmethod
     def poll(cls, context):
@@ -421,35 +865,21 @@ class SpritifyOperator(bpy.types.Operator):
           in directory of blend file. However, being missing/empty
           isn't a reliable way of determining if the render finished.
         '''
+        if context.scene is None:
+            return False
         tmp_path = bpy.path.abspath(context.scene.render.filepath)
-        if context.scene is not None:
-            if not os.path.isdir(tmp_path):
-                return True  # FIXME: See comment in next line.
-        if (context.scene is not None) and len(os.listdir(tmp_path)) > 0:
+        # poll runs on every redraw, so a single scandir probe stands in for
+        #   both the isdir check and the emptiness check.
+        try:
             # FIXME: a bit hacky; an empty dir doesn't necessarily mean
             #   that the render has been done
-            return True
-        else:
-            return False
-            print("[Spritify] not done yet")
-
-    def execute(self, context):
-        toggle = False
-        if not context.scene.spritesheet.auto_sprite:
-            context.scene.spritesheet.auto_sprite = True
-            toggle = True
-        self.show_results(
-            spritify(self, context.scene)
-        )
-
-        if toggle:
-            context.scene.spritesheet.auto_sprite = False
-        return {'FINISHED'}
+            return dir_nonempty(tmp_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return True  # FIXME: See comment above.
 
     def show_results(self, results):
         '''
         Handle output from helper functions (show error or message if any).
-        See also show_results in GIFifyOperator.
         '''
         if results is not None:
             error = results.get('error')
@@ -460,7 +890,30 @@ class SpritifyOperator(bpy.types.Operator):
                 self.report({'INFO'}, message)
 
 
-class GIFifyOperator(bpy.types.Operator):
+class SpritifyOperator(SpritifyOperatorMixin, bpy.types.Operator):
+    """
+    Generate a sprite sheet from completed animation render
+    (This operator just wraps the handler to make things easy if
+    auto_sprite is False).
+    """
+    bl_idname = "render.spritify"
+    bl_label = "Generate a sprite sheet from a completed animation render"
+
+    def execute(self, context):
+        toggle = False
+        if not context.scene.spritesheet.auto_sprite:
+            context.scene.spritesheet.auto_sprite = True
+            toggle = True
+        self.show_results(
+            spritify(context.scene, self)
+        )
+
+        if toggle:
+            context.scene.spritesheet.auto_sprite = False
+        return {'FINISHED'}
+
+
+class GIFifyOperator(SpritifyOperatorMixin, bpy.types.Operator):
     """
     Generate an animated GIF from completed animation render
     (This Operator just wraps the handler if auto_gif is False).
@@ -468,27 +921,6 @@ class GIFifyOperator(bpy.types.Operator):
     bl_idname = "render.gifify"
     bl_label = "Generate an animated GIF from a completed animation render"
 
-    @classmethod
-    def poll(cls, context):
-        '''
-        Check if rendering is finished.
-        See FIXME notes below regarding:
-        - context.scene.render.filepath is //tmp which resolves to tmp
-          in directory of blend file. However, being missing/empty
-          isn't a reliable way of determining if the render finished.
-        '''
-        tmp_path = bpy.path.abspath(context.scene.render.filepath)
-        if context.scene is not None:
-            if not os.path.isdir(tmp_path):
-                return True  # FIXME: See comment in next line.
-        if ((context.scene is not None) and (len(os.listdir(tmp_path)) > 0)):
-            # FIXME: a bit hacky; an empty dir doesn't necessarily mean
-            #   that the render has been done
-            return True
-        else:
-            return False
-            print("[Spritify] not done yet")
-
     def execute(self, context):
         toggle = False
         if not context.scene.spritesheet.auto_gif:
@@ -497,31 +929,11 @@ class GIFifyOperator(bpy.types.Operator):
         self.show_results(
             gifify(context.scene, self)
         )
-        if results is not None:
-            error = results.get('error')
-            message = results.get('message')
-            if error is not None:
-                self.report({'ERROR'}, error)
-            elif message is not None:
-                self.report({'INFO'}, message)
 
         if toggle:
             context.scene.spritesheet.auto_gif = False
         return {'FINISHED'}
 
-    def show_results(self, results):
-        '''
-        Handle output from helper functions (show error or message if any).
-        See also show_results in SpritifyOperator.
-        '''
-        if results is not None:
-            error = results.get('error')
-            message = results.get('message')
-            if error is not None:
-                self.report({'ERROR'}, error)
-            elif message is not None:
-                self.report({'INFO'}, message)
-
 
 class SpritifyPanel(bpy.types.Panel):
     """UI Panel for Spritify"""
@@ -535,6 +947,7 @@ class SpritifyPanel(bpy.types.Panel):
         layout = self.layout
 
         layout.prop(context.scene.spritesheet, "imagemagick_path")
+        layout.prop(context.scene.spritesheet, "use_graphicsmagick")
         layout.prop(context.scene.spritesheet, "filepath")
         box = layout.box()
         split = box.split(factor=0.5)
@@ -552,7 +965,9 @@ class SpritifyPanel(bpy.types.Panel):
         col = split.column()
         col.prop(context.scene.spritesheet, "bg_color")
         col.prop(context.scene.spritesheet, "quality", slider=True)
+        col.prop(context.scene.spritesheet, "color_mode", text="")
         box.prop(context.scene.spritesheet, "support_multiview")
+        box.prop(context.scene.spritesheet, "use_builtin_montage")
         box = layout.box()
         split = box.split(factor=0.5)
         col = split.column()
@@ -570,8 +985,7 @@ def register():
     bpy.types.Scene.spritesheet = bpy.props.PointerProperty(
         type=SpriteSheetProperties
     )
-    bpy.app.handlers.render_complete.append(spritify)
-    bpy.app.handlers.render_complete.append(gifify)
+    bpy.app.handlers.render_complete.append(render_complete)
     bpy.utils.register_class(SpritifyOperator)
     bpy.utils.register_class(GIFifyOperator)
     bpy.utils.register_class(SpritifyPanel)
@@ -581,8 +995,7 @@ def unregister():
     bpy.utils.unregister_class(SpritifyPanel)
     bpy.utils.unregister_class(SpritifyOperator)
     bpy.utils.unregister_class(GIFifyOperator)
-    bpy.app.handlers.render_complete.remove(spritify)
-    bpy.app.handlers.render_complete.remove(gifify)
+    bpy.app.handlers.render_complete.remove(render_complete)
     del bpy.types.Scene.spritesheet
     bpy.utils.unregister_class(SpriteSheetProperties)
 